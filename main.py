@@ -6,15 +6,14 @@ import numpy as np
 import pytorch_lightning as pl
 import torch
 import torch.nn.functional as F
+import torchmetrics
 import yaml
 from pytorch_lightning.callbacks import LearningRateMonitor, ModelCheckpoint
 from pytorch_lightning.loggers.neptune import NeptuneLogger
-from scikitplot.metrics import plot_confusion_matrix
-from sklearn.metrics import accuracy_score
 from torch.optim.lr_scheduler import LambdaLR
 from torch.utils.data import DataLoader
+from torch.utils.data import Dataset
 from torch.utils.data import random_split
-from torchvision import transforms
 from torchvision.datasets import MNIST
 
 ROOT_NAMESPACE = "session"
@@ -24,26 +23,25 @@ ROOT_NAMESPACE = "session"
 class LitModel(pl.LightningModule):
     def __init__(self, linear_1, linear_2, learning_rate, decay_factor):
         super().__init__()
-        self.linear = linear_1
-        self.linear = linear_2
-        self.learning_rate = learning_rate
-        self.decay_factor = decay_factor
-        self.layer_1 = torch.nn.Linear(28 * 28, linear_1)
-        self.layer_2 = torch.nn.Linear(linear_1, linear_2)
-        self.layer_3 = torch.nn.Linear(linear_2, 10)
+        self.save_hyperparameters()
+        self.net = torch.nn.Sequential(
+            torch.nn.Flatten(),
+            torch.nn.Linear(28 * 28, self.hparams.linear_1),
+            torch.nn.ReLU(inplace=True),
+            torch.nn.Linear(self.hparams.linear_1, self.hparams.linear_2),
+            torch.nn.ReLU(inplace=True),
+            torch.nn.Linear(self.hparams.linear_2, 10),
+        )
+        self.train_acc = torchmetrics.Accuracy(num_classes=10)
+        self.val_acc = torchmetrics.Accuracy(num_classes=10)
+        self.test_acc = torchmetrics.Accuracy(num_classes=10)
 
     def forward(self, x):
-        x = x.view(x.size(0), -1)
-        x = self.layer_1(x)
-        x = F.relu(x)
-        x = self.layer_2(x)
-        x = F.relu(x)
-        x = self.layer_3(x)
-        return x
+        return self.net(x)
 
     def configure_optimizers(self):
-        optimizer = torch.optim.Adam(self.parameters(), lr=self.learning_rate)
-        scheduler = LambdaLR(optimizer, lambda epoch: self.decay_factor ** epoch)
+        optimizer = torch.optim.Adam(self.parameters(), lr=self.hparams.learning_rate)
+        scheduler = LambdaLR(optimizer, lambda epoch: self.hparams.decay_factor ** epoch)
         return [optimizer], [scheduler]
 
     def training_step(self, batch, batch_idx):
@@ -52,110 +50,104 @@ class LitModel(pl.LightningModule):
         loss = F.cross_entropy(y_hat, y)
         self.log("train/batch/loss", loss, prog_bar=False)
 
-        y_true = y.cpu().detach().numpy()
-        y_pred = y_hat.argmax(axis=1).cpu().detach().numpy()
-        acc = accuracy_score(y_true, y_pred)
-        self.log("train/batch/acc", acc)
+        # single on-device reduction, integer predictions skip the metric's own softmax/argmax
+        y_pred = y_hat.argmax(dim=1)
+        self.log("train/batch/acc", (y_pred == y).float().mean())
+        self.train_acc.update(y_pred, y)
 
-        return {"loss": loss,
-                "y_true": y_true,
-                "y_pred": y_pred}
+        return {"loss": loss}
 
     def training_epoch_end(self, outputs):
-        loss = np.array([])
-        y_true = np.array([])
-        y_pred = np.array([])
-        for results_dict in outputs:
-            loss = np.append(loss, results_dict["loss"])
-            y_true = np.append(y_true, results_dict["y_true"])
-            y_pred = np.append(y_pred, results_dict["y_pred"])
-        acc = accuracy_score(y_true, y_pred)
-        self.log("train/epoch/loss", loss.mean())
-        self.log("train/epoch/acc", acc)
+        loss = torch.stack([results_dict["loss"].detach() for results_dict in outputs])
+        self.log("train/epoch/loss", loss.mean(), sync_dist=True)
+        self.log("train/epoch/acc", self.train_acc.compute())
+        self.train_acc.reset()
 
     def validation_step(self, batch, batch_idx):
         x, y = batch
         y_hat = self(x)
         loss = F.cross_entropy(y_hat, y)
+        y_pred = y_hat.argmax(dim=1)
+        self.val_acc.update(y_pred, y)
+
+        results = {"loss": loss}
 
-        y_true = y.cpu().detach().numpy()
-        y_pred = y_hat.argmax(axis=1).cpu().detach().numpy()
+        # example prediction, uploaded every 5 epochs
+        if self.current_epoch % 5 == 0 and batch_idx == 0:
+            # undo the normalization on the device, then copy the single image to the host
+            img = x[0, 0].detach().mul(0.3081).add_(0.1307).cpu().numpy()
 
-        # example prediction
-        img = np.squeeze(x[0].detach().cpu())
-        img = img.mul_(0.3081).add_(0.1307).numpy()
+            # softmax in fp32 on the device, under fp16 autocast y_hat is Half and CPU has no Half softmax
+            probs = F.softmax(y_hat[0].detach().float(), dim=0).tolist()
+            name = "pred: {}".format(y_pred[0].item())
+            desc_target = "target: {}".format(y[0].item())
+            desc_classes = "\n".join("class {}: {:.4f}".format(j, prob) for j, prob in enumerate(probs))
+            description = "{} \n{}".format(desc_target, desc_classes)
 
-        output = y_hat[0].detach().cpu()
-        name = "pred: {}".format(y_pred[0])
-        desc_target = "target: {}".format(y_true[0])
-        desc_classes = "\n".join(["class {}: {}".format(j, pred)
-                                 for j, pred in enumerate(F.softmax(output, dim=0))])
-        description = "{} \n{}".format(desc_target, desc_classes)
+            results["predictions"] = {"img": img,
+                                      "name": name,
+                                      "description": description}
 
-        return {"loss": loss,
-                "y_true": y_true,
-                "y_pred": y_pred,
-                "predictions": {"img": img,
-                                "name": name,
-                                "description": description}
-                }
+        return results
 
     def validation_epoch_end(self, outputs):
-        loss = np.array([])
-        y_true = np.array([])
-        y_pred = np.array([])
-        image_preds = np.array([])
+        loss = torch.stack([results_dict["loss"] for results_dict in outputs])
+
+        self.log("val/loss", loss.mean(), sync_dist=True)
+        self.log("val/acc", self.val_acc.compute())
+        self.val_acc.reset()
 
         for results_dict in outputs:
-            loss = np.append(loss, results_dict["loss"])
-            y_true = np.append(y_true, results_dict["y_true"])
-            y_pred = np.append(y_pred, results_dict["y_pred"])
-            image_preds = np.append(image_preds, results_dict["predictions"])
-
-        acc = accuracy_score(y_true, y_pred)
-        self.log("val/loss", loss.mean())
-        self.log("val/acc", acc)
-
-        if self.current_epoch % 5 == 0:
-            for data in image_preds:
-                neptune_logger.experiment[f"{ROOT_NAMESPACE}/val/preds/epoch_{self.current_epoch}"].log(
-                    value=neptune.types.File.as_image(data["img"]),
-                    name=data["name"],
-                    description=data["description"],
-                )
+            if "predictions" not in results_dict:
+                continue
+            data = results_dict["predictions"]
+            neptune_logger.experiment[f"{ROOT_NAMESPACE}/val/preds/epoch_{self.current_epoch}"].log(
+                value=neptune.types.File.as_image(data["img"]),
+                name=data["name"],
+                description=data["description"],
+            )
 
     def test_step(self, batch, batch_idx):
         x, y = batch
         y_hat = self(x)
         loss = F.cross_entropy(y_hat, y)
+        y_pred = y_hat.argmax(dim=1)
+        self.test_acc.update(y_pred, y)
+
+        # misclassified images, rescaled to [0, 1] on the device and copied to the host once per batch
+        wrong = (y_pred != y).nonzero(as_tuple=True)[0]
+        if wrong.numel():
+            imgs = x[wrong].clamp(min=0)
+            imgs = imgs / imgs.amax(dim=(1, 2, 3), keepdim=True)
+            for img, pred, true in zip(imgs.squeeze(1).cpu().numpy(), y_pred[wrong].tolist(), y[wrong].tolist()):
+                neptune_logger.experiment[f"{ROOT_NAMESPACE}/test/misclassified_images"].log(
+                    neptune.types.File.as_image(img),
+                    description="y_pred={}, y_true={}".format(pred, true),
+                )
 
-        y_true = y.cpu().detach().numpy()
-        y_pred = y_hat.argmax(axis=1).cpu().detach().numpy()
+        return {"loss": loss}
 
-        for j in np.where(np.not_equal(y_true, y_pred))[0]:
-            img = np.squeeze(x[j].cpu().detach().numpy())
-            img[img < 0] = 0
-            img = img / np.amax(img)
-            neptune_logger.experiment[f"{ROOT_NAMESPACE}/test/misclassified_images"].log(
-                neptune.types.File.as_image(img),
-                description="y_pred={}, y_true={}".format(y_pred[j], y_true[j]),
-            )
+    def test_epoch_end(self, outputs):
+        loss = torch.stack([results_dict["loss"] for results_dict in outputs])
+        self.log("test/loss", loss.mean(), sync_dist=True)
+        self.log("test/acc", self.test_acc.compute())
+        self.test_acc.reset()
 
-        return {"loss": loss,
-                "y_true": y_true,
-                "y_pred": y_pred}
 
-    def test_epoch_end(self, outputs):
-        loss = np.array([])
-        y_true = np.array([])
-        y_pred = np.array([])
-        for results_dict in outputs:
-            loss = np.append(loss, results_dict["loss"])
-            y_true = np.append(y_true, results_dict["y_true"])
-            y_pred = np.append(y_pred, results_dict["y_pred"])
-        acc = accuracy_score(y_true, y_pred)
-        self.log("test/loss", loss.mean())
-        self.log("test/acc", acc)
+# memory-mapped MNIST split, pages are shared between dataloader workers
+class MNISTMemmap(Dataset):
+    def __init__(self, images_path, labels_path, normalization_vector):
+        self.images = np.load(images_path, mmap_mode="r")
+        self.labels = np.load(labels_path, mmap_mode="r")
+        self.mean = normalization_vector[0][0] * 255
+        self.std = normalization_vector[1][0] * 255
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        img = torch.from_numpy(self.images[index].copy()).float().unsqueeze(0)
+        return img.sub_(self.mean).div_(self.std), int(self.labels[index])
 
 
 # define DataModule
@@ -168,48 +160,102 @@ class MNISTDataModule(pl.LightningDataModule):
         self.mnist_val = None
         self.mnist_test = None
 
+    def _npy_path(self, train, kind):
+        split = "train" if train else "test"
+        return os.path.join(os.getcwd(), "MNIST", "npy", "{}_{}.npy".format(split, kind))
+
     def prepare_data(self):
-        MNIST(os.getcwd(), train=True, download=True)
-        MNIST(os.getcwd(), train=False, download=True)
+        # convert each split once to raw uint8 arrays that can be memory-mapped
+        os.makedirs(os.path.join(os.getcwd(), "MNIST", "npy"), exist_ok=True)
+        for train in (True, False):
+            if os.path.exists(self._npy_path(train, "labels")):
+                continue
+            mnist = MNIST(os.getcwd(), train=train, download=True)
+            np.save(self._npy_path(train, "images"), mnist.data.numpy())
+            np.save(self._npy_path(train, "labels"), mnist.targets.numpy().astype(np.uint8))
 
     def setup(self, stage):
-        # transforms
-        transform = transforms.Compose([transforms.ToTensor(),
-                                        transforms.Normalize(self.normalization_vector[0],
-                                                             self.normalization_vector[1])])
         if stage == "fit":
-            mnist_train = MNIST(os.getcwd(), train=True, transform=transform)
+            mnist_train = MNISTMemmap(self._npy_path(True, "images"), self._npy_path(True, "labels"),
+                                      self.normalization_vector)
             self.mnist_train, self.mnist_val = random_split(mnist_train, [55000, 5000])
         if stage == "test":
-            self.mnist_test = MNIST(os.getcwd(), train=False, transform=transform)
+            self.mnist_test = MNISTMemmap(self._npy_path(False, "images"), self._npy_path(False, "labels"),
+                                          self.normalization_vector)
+
+    @property
+    def train_num_workers(self):
+        # split the available cores between the DDP processes
+        world_size = self.trainer.world_size if self.trainer is not None else 1
+        return max(1, os.cpu_count() // world_size)
+
+    def _dataloader(self, dataset, num_workers=2, shuffle=False, drop_last=False, persistent_workers=True):
+        # pinned batches let Lightning copy them to the GPU with non_blocking=True,
+        # val/test only read a small memory-mapped split, so a fixed pool of 2 workers is enough
+        return DataLoader(dataset, batch_size=self.batch_size, shuffle=shuffle, drop_last=drop_last,
+                          num_workers=num_workers, pin_memory=True,
+                          persistent_workers=persistent_workers, prefetch_factor=4)
 
     def train_dataloader(self):
-        mnist_train = DataLoader(self.mnist_train, batch_size=self.batch_size, num_workers=4)
+        # fixed batch shape for every training step
+        mnist_train = self._dataloader(self.mnist_train, num_workers=self.train_num_workers,
+                                       shuffle=True, drop_last=True)
         return mnist_train
 
     def val_dataloader(self):
-        mnist_val = DataLoader(self.mnist_val, batch_size=self.batch_size, num_workers=4)
+        mnist_val = self._dataloader(self.mnist_val)
         return mnist_val
 
-    def test_dataloader(self):
-        mnist_test = DataLoader(self.mnist_test, batch_size=self.batch_size, num_workers=1)
+    def test_dataloader(self, persistent_workers=True):
+        mnist_test = self._dataloader(self.mnist_test, persistent_workers=persistent_workers)
         return mnist_test
 
 
+# (neptune) log total gradient L2 norm as a single reduction
+class GradNormMonitor(pl.Callback):
+    def on_before_optimizer_step(self, trainer, pl_module, optimizer, opt_idx):
+        # gradients are already unscaled here, log at the same cadence as other step metrics
+        if (trainer.global_step + 1) % trainer.log_every_n_steps != 0:
+            return
+        norms = [p.grad.detach().norm(2) for p in pl_module.parameters() if p.grad is not None]
+        pl_module.log("grad_2.0_norm_total", torch.stack(norms).norm(2))
+
+
 # (neptune) log confusion matrix for classification
 def log_confusion_matrix(lit_model, data_module):
     lit_model.freeze()
-    test_data = data_module.test_dataloader()
-    y_true = np.array([])
-    y_pred = np.array([])
-    for i, (x, y) in enumerate(test_data):
-        y = y.cpu().detach().numpy()
-        y_hat = lit_model.forward(x).argmax(axis=1).cpu().detach().numpy()
-        y_true = np.append(y_true, y)
-        y_pred = np.append(y_pred, y_hat)
+    if torch.cuda.is_available():
+        device = torch.device("cuda")
+        net = lit_model.net.to(device)
+    else:
+        # training is done, int8 weights are enough for inference (dynamic quantization is CPU only)
+        device = torch.device("cpu")
+        net = torch.quantization.quantize_dynamic(lit_model.net.cpu(), {torch.nn.Linear}, dtype=torch.qint8)
+    # single pass over the test set, no worker pool to keep alive afterwards
+    test_data = data_module.test_dataloader(persistent_workers=False)
+    y_true = torch.empty(len(data_module.mnist_test), dtype=torch.long, device=device)
+    y_pred = torch.empty_like(y_true)
+    offset = 0
+    with torch.no_grad():
+        for x, y in test_data:
+            batch_size = y.size(0)
+            y_true[offset:offset + batch_size] = y.to(device, non_blocking=True)
+            y_pred[offset:offset + batch_size] = net(x.to(device, non_blocking=True)).argmax(dim=1)
+            offset += batch_size
+
+    # rows are true labels, columns are predicted labels
+    cm = torch.zeros(10, 10, dtype=torch.long, device=device)
+    cm.index_put_((y_true, y_pred), torch.ones_like(y_true), accumulate=True)
+    cm = cm.cpu().numpy()
 
     fig, ax = plt.subplots(figsize=(16, 12))
-    plot_confusion_matrix(y_true, y_pred, ax=ax)
+    image = ax.imshow(cm, interpolation="nearest", cmap="Blues")
+    fig.colorbar(image, ax=ax)
+    for i, j in np.ndindex(cm.shape):
+        ax.text(j, i, cm[i, j], ha="center", va="center",
+                color="white" if cm[i, j] > cm.max() / 2 else "black")
+    ax.set(xticks=range(10), yticks=range(10), title="Confusion Matrix",
+           xlabel="Predicted label", ylabel="True label")
     neptune_logger.experiment[f"{ROOT_NAMESPACE}/confusion_matrix"].upload(neptune.types.File.as_image(fig))
 
 
@@ -238,13 +284,34 @@ neptune_logger = NeptuneLogger(
     prefix=ROOT_NAMESPACE,
 )
 
+# use DDP over all visible GPUs, fall back to a single CPU process
+gpu_available = torch.cuda.is_available()
+
+# allow TF32 tensor cores for fp32 matmuls and convolutions on Ampere+
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
+# mixed precision: bf16 needs no loss scaling, fall back to fp16 on older GPUs
+if not gpu_available:
+    precision = 32
+elif getattr(torch.cuda, "is_bf16_supported", lambda: False)():
+    precision = "bf16"
+else:
+    precision = 16
+
 # (neptune) initialize a trainer and pass neptune_logger
 trainer = pl.Trainer(
     logger=neptune_logger,
-    callbacks=[lr_logger, model_checkpoint],
+    callbacks=[lr_logger, model_checkpoint, GradNormMonitor()],
     log_every_n_steps=50,
     max_epochs=parameters["max_epochs"],
-    track_grad_norm=2,
+    accelerator="gpu" if gpu_available else "cpu",
+    devices=-1 if gpu_available else 1,
+    strategy="ddp" if gpu_available else None,
+    sync_batchnorm=False,
+    precision=precision,
+    amp_backend="native",
+    benchmark=True,
 )
 
 # init model
@@ -264,12 +331,29 @@ dm = MNISTDataModule(
 # (neptune) log model summary
 neptune_logger.log_model_summary(model=model, max_depth=-1)
 
-# (neptune) log hyper-parameters
-neptune_logger.log_hyperparams(params=parameters)
+# (neptune) log hyper-parameters, LitModel logs its own init args (save_hyperparameters)
+neptune_logger.log_hyperparams(params={"batch_size": parameters["batch_size"],
+                                       "max_epochs": parameters["max_epochs"]})
 
-# train and test the model, log metadata to the Neptune run
+# train the model, log metadata to the Neptune run
 trainer.fit(model, datamodule=dm)
-trainer.test(model, datamodule=dm)
 
-# (neptune) log confusion matrix
-log_confusion_matrix(model, dm)
+# Lightning keeps the DDP process group alive after fit, and torchmetrics / sync_dist
+# reduce over it whenever it exists; tear it down on every rank before testing on one device
+if torch.distributed.is_available() and torch.distributed.is_initialized():
+    torch.distributed.destroy_process_group()
+
+# test once on a single device, so every test sample is evaluated and logged exactly once
+# (a DDP test would shard and pad the test set, and only rank 0 has a real Neptune run)
+if trainer.is_global_zero:
+    test_trainer = pl.Trainer(
+        logger=neptune_logger,
+        accelerator="gpu" if gpu_available else "cpu",
+        devices=1,
+        precision=precision,
+        amp_backend="native",
+    )
+    test_trainer.test(model, datamodule=dm)
+
+    # (neptune) log confusion matrix
+    log_confusion_matrix(model, dm)